@@ -1,10 +1,23 @@
 import os
+import argparse
+import hashlib
+import io
+import itertools
+import random
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+from psycopg2 import sql
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
-from tqdm import tqdm
-from datetime import datetime
+from pgvector.psycopg2 import register_vector
+from rapidfuzz import fuzz
 
 # Init script
 print("🚀 Initializing Transformation Script...")
@@ -27,104 +40,287 @@ DB_PARAMS = {
     "port": "5432"
 }
 
+# Shared pool so connection setup is paid once per process
+POOL = psycopg2.pool.ThreadedConnectionPool(minconn=2, maxconn=10, **DB_PARAMS)
+
 POSTER_BASE_URL = "https://image.tmdb.org/t/p/w500"
 EMBEDDING_MODEL = "models/embedding-001" # Gemini API model
+FETCH_ITERSIZE = 1000 # rows per server-side cursor round-trip
+BATCH_SIZE = 500 # movies per embed/upsert batch
+EMBED_BATCH_SIZE = 100 # texts per embed_content request (API limit)
+EMBED_MAX_WORKERS = 5 # concurrent embed_content requests
+EMBED_MAX_RETRIES = 5 # retries on 429 before giving up
+FUZZY_MATCH_THRESHOLD = 97 # min rapidfuzz ratio to reuse a near-duplicate embedding
+
+# Postgres binary COPY framing
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+PGCOPY_NULL = struct.pack(">i", -1)
+
+# Production upsert statements, composed once at import
+PRODUCTION_COLUMNS = ("id", "title", "overview", "release_year", "rating", "poster_url", "embedding")
+_COLUMN_LIST = sql.SQL(", ").join(map(sql.Identifier, PRODUCTION_COLUMNS))
+COPY_STAGE_SQL = sql.SQL("COPY _stage ({cols}) FROM STDIN WITH (FORMAT BINARY);").format(cols=_COLUMN_LIST)
+UPSERT_FROM_STAGE_SQL = sql.SQL("""
+    INSERT INTO public.movies_production ({cols})
+    SELECT {cols} FROM _stage
+    ON CONFLICT (id) DO UPDATE SET {updates};
+""").format(
+    cols=_COLUMN_LIST,
+    updates=sql.SQL(", ").join(
+        sql.SQL("{col} = EXCLUDED.{col}").format(col=sql.Identifier(col))
+        for col in PRODUCTION_COLUMNS if col != "id"
+    ),
+)
+
+@contextmanager
+def get_conn():
+    """Borrow a connection from the pool"""
+    conn = POOL.getconn()
+    try:
+        yield conn
+    finally:
+        POOL.putconn(conn)
 
 def fetch_raw_movies(conn):
-    """Fetch movies from staging table"""
-    print("📖 Fetching raw movie data from the staging table...")
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+    """Stream movies from staging table"""
+    print("📖 Streaming raw movie data from the staging table...")
+    # Named (server-side) cursor so rows arrive in itersize batches instead of
+    # all at once; give it its own connection so upsert commits don't close it
+    with conn.cursor(name="raw_movies_cur", cursor_factory=psycopg2.extras.DictCursor) as cursor:
+        cursor.itersize = FETCH_ITERSIZE
         cursor.execute("""
             SELECT id, title, overview, poster_path, release_date, vote_average
             FROM tmdb_data.raw_movies;
         """)
-        movies = cursor.fetchall()
-        print(f"✅ Found {len(movies)} movies to process.")
-        return movies
+        yield from cursor
 
-def transform_and_embed_batch(movies_raw):
-    """Transform data and generate embeddings"""
-    print("✨ Preparing batch for transformation and embedding...")
-    texts_to_embed = []
-    transformed_movies = []
-
-    for movie in movies_raw:
-        # Transform movie data
-        title = movie['title'] or ""
-        overview = movie['overview'] or "No overview available."
-
-        release_year = None
-        if movie['release_date']:
-            try:
-                release_year = datetime.strptime(movie['release_date'], '%Y-%m-%d').year
-            except (ValueError, TypeError):
-                release_year = None
-
-        rating = round(movie['vote_average'], 1) if movie['vote_average'] is not None else 0.0
-        poster_url = f"{POSTER_BASE_URL}{movie['poster_path']}" if movie['poster_path'] else None
-
-        # Prep embedding text
-        semantic_text = f"Movie Title: {title}. Overview: {overview}"
-        texts_to_embed.append(semantic_text)
-
-        transformed_movies.append({
-            "id": movie['id'],
-            "title": title,
-            "overview": overview,
-            "release_year": release_year,
-            "rating": rating,
-            "poster_url": poster_url,
-        })
+def _embed(batch):
+    """Embed one API-sized batch, backing off on rate limits"""
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            return genai.embed_content(
+                model=EMBEDDING_MODEL,
+                content=batch,
+                task_type="RETRIEVAL_DOCUMENT",
+            )['embedding']
+        except google_exceptions.ResourceExhausted:
+            if attempt == EMBED_MAX_RETRIES:
+                raise
+            # Exponential backoff with jitter so workers don't retry in lockstep
+            time.sleep(2 ** attempt + random.uniform(0, 0.5))
+
+def embed_texts(texts):
+    """Embed texts in concurrent API-sized batches, preserving order"""
+    # Duplicate texts (re-releases, collection entries) only cost one API call
+    unique_texts = list(dict.fromkeys(texts))
+    batches = [unique_texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(unique_texts), EMBED_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS) as executor:
+        results = executor.map(_embed, batches)
+        embeddings = [embedding for batch in results for embedding in batch]
+    embedding_by_text = dict(zip(unique_texts, embeddings))
+    return [embedding_by_text[text] for text in texts]
+
+def _normalize_text(text):
+    """Collapse case and whitespace so trivial edits hit the cache exactly"""
+    return " ".join(text.lower().split())
+
+def lookup_cached_embeddings(conn, text_hashes):
+    """Fetch cached embeddings for the current model by text hash"""
+    if not text_hashes:
+        return {}
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT text_hash, embedding
+            FROM public.embedding_cache
+            WHERE model = %s AND text_hash = ANY(%s);
+        """, (EMBEDDING_MODEL, [psycopg2.Binary(h) for h in text_hashes]))
+        # pgvector returns Vector objects; convert so hits mix with fresh embeddings
+        return {bytes(text_hash): embedding.to_numpy() for text_hash, embedding in cursor.fetchall()}
+
+def lookup_similar_embeddings(conn, movie_ids, texts):
+    """Reuse a movie's cached embedding when its text barely changed"""
+    if not movie_ids:
+        return {}
+    candidates = {}
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT movie_id, text, embedding
+            FROM public.embedding_cache
+            WHERE model = %s AND movie_id = ANY(%s);
+        """, (EMBEDDING_MODEL, list(set(movie_ids))))
+        for movie_id, cached_text, embedding in cursor.fetchall():
+            candidates.setdefault(movie_id, []).append((cached_text, embedding.to_numpy()))
+
+    matches = {}
+    for i, (movie_id, text) in enumerate(zip(movie_ids, texts)):
+        best_score, best_embedding = 0, None
+        for cached_text, embedding in candidates.get(movie_id, []):
+            score = fuzz.ratio(text, cached_text)
+            if score > best_score:
+                best_score, best_embedding = score, embedding
+        if best_score > FUZZY_MATCH_THRESHOLD:
+            matches[i] = best_embedding
+    return matches
+
+def store_cached_embeddings(conn, entries_by_hash):
+    """Save freshly generated embeddings to the cache"""
+    # ndarrays go through the registered pgvector adapter as one '[...]' literal
+    # rather than psycopg2's default ARRAY[...] of float reprs
+    rows = [
+        (psycopg2.Binary(text_hash), EMBEDDING_MODEL, movie_id, text, np.asarray(embedding, dtype=np.float32))
+        for text_hash, (movie_id, text, embedding) in entries_by_hash.items()
+    ]
+    with conn.cursor() as cursor:
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO public.embedding_cache (text_hash, model, movie_id, text, embedding)
+            VALUES %s
+            ON CONFLICT (model, text_hash) DO UPDATE SET
+                movie_id = EXCLUDED.movie_id,
+                text = EXCLUDED.text,
+                embedding = EXCLUDED.embedding;
+        """, rows)
+        conn.commit()
 
-    print(f"🤖 Calling Gemini API to generate embeddings for {len(texts_to_embed)} movies...")
-    result = genai.embed_content(
-        model=EMBEDDING_MODEL,
-        content=texts_to_embed,
-        task_type="RETRIEVAL_DOCUMENT",
+def get_embeddings(conn, movie_ids, texts, use_cache=True):
+    """Resolve embeddings from the cache, calling Gemini only for misses"""
+    if not use_cache:
+        print(f"🤖 Calling Gemini API to generate embeddings for {len(texts)} movies (cache disabled)...")
+        return embed_texts(texts)
+
+    # Exact hit on the normalized text first
+    normalized_texts = [_normalize_text(text) for text in texts]
+    text_hashes = [hashlib.sha256(text.encode()).digest() for text in normalized_texts]
+    embeddings_by_hash = lookup_cached_embeddings(conn, text_hashes)
+    embeddings = [embeddings_by_hash.get(text_hash) for text_hash in text_hashes]
+
+    # Then a near-duplicate of the same movie's previous text
+    misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    similar = lookup_similar_embeddings(
+        conn,
+        [movie_ids[i] for i in misses],
+        [normalized_texts[i] for i in misses],
     )
+    for j, embedding in similar.items():
+        embeddings[misses[j]] = embedding
+    misses = [i for i in misses if embeddings[i] is None]
+    print(f"🗃️ Reused {len(texts) - len(misses)} cached embeddings ({len(similar)} near-duplicates).")
+
+    if misses:
+        print(f"🤖 Calling Gemini API to generate embeddings for {len(misses)} movies...")
+        new_embeddings = embed_texts([texts[i] for i in misses])
+        store_cached_embeddings(conn, {
+            text_hashes[i]: (movie_ids[i], normalized_texts[i], embedding)
+            for i, embedding in zip(misses, new_embeddings)
+        })
+        for i, embedding in zip(misses, new_embeddings):
+            embeddings[i] = embedding
+
+    return embeddings
+
+def _release_year(release_date):
+    """Extract the year from an ISO date string or date without parsing"""
+    if not release_date:
+        return None
+    if not isinstance(release_date, str):
+        return release_date.year
+    if len(release_date) >= 4 and release_date[:4].isdecimal():
+        return int(release_date[:4])
+    return None
 
-    embeddings = result['embedding']
+def transform_and_embed_batch(conn, movies_raw, use_cache=True):
+    """Transform data and generate embeddings as production row tuples"""
+    print("✨ Preparing batch for transformation and embedding...")
+    # Column-wise transform
+    ids = [movie['id'] for movie in movies_raw]
+    titles = [movie['title'] or "" for movie in movies_raw]
+    overviews = [movie['overview'] or "No overview available." for movie in movies_raw]
+    release_years = [_release_year(movie['release_date']) for movie in movies_raw]
+    # Python's correctly rounded round(); np.round rounds half to even after scaling
+    # and would store e.g. 8.65 as 8.6
+    ratings = [
+        round(vote_average, 1) if (vote_average := movie['vote_average']) is not None else 0.0
+        for movie in movies_raw
+    ]
+    poster_urls = [
+        POSTER_BASE_URL + poster_path if (poster_path := movie['poster_path']) else None
+        for movie in movies_raw
+    ]
+    texts_to_embed = [
+        f"Movie Title: {title}. Overview: {overview}"
+        for title, overview in zip(titles, overviews)
+    ]
+
+    embeddings = get_embeddings(conn, ids, texts_to_embed, use_cache=use_cache)
 
-    for i, movie in enumerate(transformed_movies):
-        movie['embedding'] = embeddings[i]
+    # Unit-length vectors make cosine ranking equal to inner product (<#>) at query time
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
 
     print("✅ Successfully generated and combined embeddings.")
-    return transformed_movies
+    return list(zip(ids, titles, overviews, release_years, ratings, poster_urls, vectors))
+
+def _encode_copy_row(movie):
+    """Encode one production row (in PRODUCTION_COLUMNS order) as a binary COPY tuple"""
+    movie_id, title, overview, release_year, rating, poster_url, embedding = movie
+    fields = [
+        struct.pack(">q", movie_id),
+        title.encode(),
+        overview.encode() if overview is not None else None,
+        struct.pack(">i", release_year) if release_year is not None else None,
+        struct.pack(">f", rating) if rating is not None else None,
+        poster_url.encode() if poster_url is not None else None,
+        # pgvector halfvec wire format: int16 dim, int16 unused, float2 values
+        struct.pack(">hh", len(embedding), 0) + np.asarray(embedding, dtype=">f2").tobytes(),
+    ]
+    parts = [struct.pack(">h", len(fields))]
+    for field in fields:
+        if field is None:
+            parts.append(PGCOPY_NULL)
+        else:
+            parts.append(struct.pack(">i", len(field)))
+            parts.append(field)
+    return b"".join(parts)
 
 def upsert_production_movies(conn, transformed_movies):
     """Upsert movies to production table"""
     print(f"💾 Upserting {len(transformed_movies)} movies into the production table...")
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    for movie in transformed_movies:
+        buffer.write(_encode_copy_row(movie))
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+
     with conn.cursor() as cursor:
-        upsert_query = """
-            INSERT INTO public.movies_production (id, title, overview, release_year, rating, poster_url, embedding)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO UPDATE SET
-                title = EXCLUDED.title,
-                overview = EXCLUDED.overview,
-                release_year = EXCLUDED.release_year,
-                rating = EXCLUDED.rating,
-                poster_url = EXCLUDED.poster_url,
-                embedding = EXCLUDED.embedding;
-        """
-        for movie in tqdm(transformed_movies, desc="Upserting movies"):
-            cursor.execute(upsert_query, (
-                movie['id'],
-                movie['title'],
-                movie['overview'],
-                movie['release_year'],
-                movie['rating'],
-                movie['poster_url'],
-                movie['embedding']
-            ))
+        # Binary COPY into a staging table, then one set-based upsert
+        cursor.execute("""
+            CREATE TEMP TABLE _stage (LIKE public.movies_production INCLUDING DEFAULTS)
+            ON COMMIT DROP;
+        """)
+        cursor.copy_expert(COPY_STAGE_SQL, buffer)
+        cursor.execute(UPSERT_FROM_STAGE_SQL)
         conn.commit()
-        print("✅ All movies have been successfully saved to the production table.")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"✅ Upserted {len(transformed_movies)} movies into the production table in {elapsed_ms:.0f} ms.")
 
 def create_production_table(conn):
-    """Setup production table and vector extension"""
+    """Setup production and cache tables and vector extension"""
     with conn.cursor() as cursor:
         print("🔍 Checking for pgvector extension and production table...")
-        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+        # All setup DDL in one round-trip. halfvec needs pgvector 0.7+, so older
+        # installs get the extension and column migrated in place; both are
+        # guarded so routine runs don't take locks on the production table
         cursor.execute("""
+            CREATE EXTENSION IF NOT EXISTS vector;
+            DO $$
+            BEGIN
+                IF to_regtype('halfvec') IS NULL THEN
+                    ALTER EXTENSION vector UPDATE;
+                END IF;
+            END $$;
+
             CREATE TABLE IF NOT EXISTS public.movies_production (
                 id BIGINT PRIMARY KEY,
                 title TEXT NOT NULL,
@@ -132,30 +328,88 @@ def create_production_table(conn):
                 release_year INTEGER,
                 rating REAL,
                 poster_url TEXT,
-                embedding VECTOR(768)
+                embedding HALFVEC(768)
             );
+            DO $$
+            BEGIN
+                IF (
+                    SELECT format_type(atttypid, atttypmod)
+                    FROM pg_attribute
+                    WHERE attrelid = 'public.movies_production'::regclass
+                      AND attname = 'embedding'
+                      AND NOT attisdropped
+                ) IS DISTINCT FROM 'halfvec(768)' THEN
+                    ALTER TABLE public.movies_production ALTER COLUMN embedding TYPE halfvec(768);
+                END IF;
+            END $$;
+
+            CREATE TABLE IF NOT EXISTS public.embedding_cache (
+                text_hash BYTEA NOT NULL,
+                model TEXT NOT NULL,
+                movie_id BIGINT,
+                text TEXT,
+                embedding VECTOR(768),
+                PRIMARY KEY (model, text_hash)
+            );
+
+            CREATE INDEX IF NOT EXISTS embedding_cache_movie_idx
+            ON public.embedding_cache (model, movie_id);
         """)
         conn.commit()
         print("✅ Database is ready.")
 
+def create_vector_index(conn):
+    """Build the HNSW index once the bulk load is done"""
+    print("🧭 Building HNSW index on production embeddings...")
+    with conn.cursor() as cursor:
+        # Building cold after the load is much faster than maintaining it per insert;
+        # inner-product ops since embeddings are unit-normalized at ingest
+        cursor.execute("SET LOCAL maintenance_work_mem = '1GB';")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS movies_prod_emb_hnsw
+            ON public.movies_production
+            USING hnsw (embedding halfvec_ip_ops)
+            WITH (m = 16, ef_construction = 64);
+        """)
+        conn.commit()
+        print("✅ Vector index is ready.")
+
 if __name__ == "__main__":
-    conn = None
+    parser = argparse.ArgumentParser(description="Transform staged movies and embed them with Gemini.")
+    parser.add_argument("--no-cache", action="store_true", help="re-embed every movie, bypassing the embedding cache")
+    args = parser.parse_args()
+
     try:
-        conn = psycopg2.connect(**DB_PARAMS)
-        print("🔗 Database connection established.")
+        with get_conn() as conn, get_conn() as read_conn, get_conn() as write_conn:
+            print("🔗 Database connections established.")
 
-        create_production_table(conn)
-        raw_movies = fetch_raw_movies(conn)
+            create_production_table(conn)
+            # Needs the vector extension, so register after the table setup
+            register_vector(conn)
 
-        if raw_movies:
-            transformed_movies = transform_and_embed_batch(raw_movies)
-            upsert_production_movies(conn, transformed_movies)
-        else:
-            print("No new movies to process.")
+            raw_movies = fetch_raw_movies(read_conn)
+            total = 0
+
+            # Upsert each batch on its own connection while the next one is embedded
+            with ThreadPoolExecutor(max_workers=1) as upsert_executor:
+                pending_upsert = None
+                while batch := list(itertools.islice(raw_movies, BATCH_SIZE)):
+                    transformed_movies = transform_and_embed_batch(conn, batch, use_cache=not args.no_cache)
+                    if pending_upsert:
+                        pending_upsert.result()
+                    pending_upsert = upsert_executor.submit(upsert_production_movies, write_conn, transformed_movies)
+                    total += len(batch)
+                if pending_upsert:
+                    pending_upsert.result()
+
+            if total:
+                create_vector_index(conn)
+                print(f"✅ Processed {total} movies.")
+            else:
+                print("No new movies to process.")
 
     except Exception as e:
         print(f"❌ An unexpected error occurred: {e}")
     finally:
-        if conn:
-            conn.close()
-            print("📦 Database connection closed.")
\ No newline at end of file
+        POOL.closeall()
+        print("📦 Database connections closed.")
\ No newline at end of file
@@ -1,6 +1,9 @@
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Config
 load_dotenv()
@@ -8,7 +11,25 @@ API_TOKEN = os.getenv("TMDB_API_READ_ACCESS_TOKEN")
 API_ENDPOINT = "https://api.themoviedb.org/3/discover/movie"
 POSTER_BASE_URL = "https://image.tmdb.org/t/p/w500"
 
-def fetch_top_rated_movies():
+# Pooled session: one TCP+TLS handshake reused across pages, retries on transient errors
+SESSION = requests.Session()
+SESSION.headers.update({
+    "accept": "application/json",
+    "Authorization": f"Bearer {API_TOKEN}"
+})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+def fetch_page(params, page):
+    """Fetch a single discover page"""
+    response = SESSION.get(API_ENDPOINT, params={**params, "page": page})
+    response.raise_for_status()
+    return response.json()
+
+def fetch_top_rated_movies(pages=1):
     """Get top rated movies from TMDB API"""
     
     if not API_TOKEN:
@@ -16,16 +37,10 @@ def fetch_top_rated_movies():
         print("Please make sure you have a .env file with your token.")
         return
 
-    headers = {
-        "accept": "application/json",
-        "Authorization": f"Bearer {API_TOKEN}"
-    }
-
     params = {
         "include_adult": "false",
         "include_video": "false", 
         "language": "en-US",
-        "page": 1,
         "sort_by": "vote_average.desc",
         "vote_count.gte": 200
     }
@@ -34,18 +49,19 @@ def fetch_top_rated_movies():
     print(f"   Endpoint: {API_ENDPOINT}")
     
     try:
-        response = requests.get(API_ENDPOINT, headers=headers, params=params)
-        response.raise_for_status()
+        # Pages are independent, so fetch them in parallel over the shared session
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            pages_data = list(executor.map(lambda page: fetch_page(params, page), range(1, pages + 1)))
         print("✅ Successfully connected to the API and received a response.")
 
-        data = response.json()
-        movies = data.get("results", [])
+        movies = [movie for data in pages_data for movie in data.get("results", [])]
 
         if not movies:
             print("🤔 No movies found in the response. Check your parameters.")
             return
 
-        print("\n--- Top Movies Found (Page 1) ---")
+        page_label = "Page 1" if pages == 1 else f"Pages 1-{pages}"
+        print(f"\n--- Top Movies Found ({page_label}) ---")
         
         for i, movie in enumerate(movies, 1):
             title = movie.get('title', 'N/A')
@@ -0,0 +1,118 @@
+import hashlib
+import importlib
+import struct
+import sys
+
+import numpy as np
+import psycopg2.pool
+import pytest
+from pgvector import Vector
+
+
+class FakeCursor:
+    """Cursor that hands out one queued result set per execute()"""
+
+    def __init__(self, results):
+        self.results = results
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.rows = self.results.pop(0)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConn:
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def cursor(self):
+        return FakeCursor(self.results)
+
+
+@pytest.fixture
+def embed(monkeypatch):
+    """Import embed.py without a real API key or database"""
+    monkeypatch.setenv("GOOGLE_API_KEY", "test-key")
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", lambda *args, **kwargs: None)
+    sys.modules.pop("embed", None)
+    yield importlib.import_module("embed")
+    sys.modules.pop("embed", None)
+
+
+def raw_movie(movie_id, title, overview):
+    return {
+        "id": movie_id,
+        "title": title,
+        "overview": overview,
+        "poster_path": "/poster.jpg",
+        "release_date": "1999-03-31",
+        "vote_average": 8.2,
+    }
+
+
+def text_hash(embed, title, overview):
+    text = embed._normalize_text(f"Movie Title: {title}. Overview: {overview}")
+    return hashlib.sha256(text.encode()).digest()
+
+
+def assert_encodes(embed, row):
+    """Check the row encodes with a well-formed trailing halfvec field"""
+    encoded = embed._encode_copy_row(row)
+    dim = len(row[6])
+    payload = struct.pack(">i", 4 + 2 * dim) + struct.pack(">hh", dim, 0)
+    assert encoded[-(2 * dim) - len(payload):-(2 * dim)] == payload
+    np.testing.assert_allclose(np.frombuffer(encoded[-(2 * dim):], dtype=">f2"), row[6], atol=1e-3)
+
+
+def test_exact_cache_hit_returns_vector(embed):
+    movie = raw_movie(1, "Heat", "A heist.")
+    conn = FakeConn([(memoryview(text_hash(embed, "Heat", "A heist.")), Vector([3.0, 4.0, 0.0]))])
+
+    rows = embed.transform_and_embed_batch(conn, [movie])
+
+    np.testing.assert_allclose(rows[0][6], [0.6, 0.8, 0.0], rtol=1e-6)
+    assert_encodes(embed, rows[0])
+
+
+def test_mixed_exact_fuzzy_and_fresh_embeddings(embed, monkeypatch):
+    movies = [
+        raw_movie(1, "Heat", "A heist."),
+        raw_movie(2, "Alien", "In space no one can hear you scream."),
+        raw_movie(3, "Brazil", "A bureaucratic nightmare."),
+    ]
+    conn = FakeConn(
+        # Exact lookup: only movie 1 hits
+        [(memoryview(text_hash(embed, "Heat", "A heist.")), Vector([1.0, 0.0, 0.0]))],
+        # Fuzzy lookup: movie 2's previous text differs by one character
+        [(2, embed._normalize_text("Movie Title: Alien. Overview: In space no one can hear you scream!"), Vector([0.0, 2.0, 0.0]))],
+    )
+    monkeypatch.setattr(embed, "embed_texts", lambda texts: [[0.0, 0.0, 5.0] for _ in texts])
+    monkeypatch.setattr(embed, "store_cached_embeddings", lambda conn, entries: None)
+
+    rows = embed.transform_and_embed_batch(conn, movies)
+
+    np.testing.assert_allclose([row[6] for row in rows], np.eye(3), atol=1e-6)
+    for row in rows:
+        assert_encodes(embed, row)
+
+
+def test_ratings_round_like_python(embed):
+    movies = [raw_movie(i, f"Movie {i}", "Plot.") for i in range(3)]
+    for movie, vote_average in zip(movies, [8.65, 6.35, None]):
+        movie["vote_average"] = vote_average
+    conn = FakeConn([
+        (memoryview(text_hash(embed, movie["title"], "Plot.")), Vector([1.0, 0.0, 0.0]))
+        for movie in movies
+    ])
+
+    rows = embed.transform_and_embed_batch(conn, movies)
+
+    assert [row[4] for row in rows] == [8.7, 6.3, 0.0]